@@ -1,7 +1,66 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
 import numpy as np
 from lxml import etree
 import pandas as pd
-def generate_osc(vehicle_data: dict, filename: str = "example_trajectory.xosc"):
+
+# Number format for all written coordinates (of Python floats), repr is the shortest string that round-trips exactly
+_FLOAT_FORMAT = '%r'
+
+# Optional WorldPosition attributes and their trajectory columns, they are only written when non-zero
+_OPTIONAL_ATTRIBUTES = {'z': 'z', 'h': 'yaw', 'p': 'pitch', 'r': 'roll'}
+
+# XPath expressions used by parse_osc, compiled once at import
+_FIND_VERTICES = etree.XPath('Shape/Polyline/Vertex')
+_FIND_WORLD_POSITION = etree.XPath('Position/WorldPosition')
+
+# Buffer size of the output file, large enough to batch the many small vertex writes into few syscalls
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# Number of vertices converted to Python floats at a time when writing a trajectory
+_CHUNK_SIZE = 1 << 16
+
+# Trajectory columns written by generate_osc
+_TRAJECTORY_COLUMNS = ['timestamp', 'x', 'y', 'z', 'yaw', 'pitch', 'roll']
+
+def _serialize_trajectory(file, vehicle_name: str, vd):
+    """
+    Writes the Trajectory element of a single vehicle as UTF-8 to the binary stream file.
+    """
+    with etree.xmlfile(file, encoding="UTF-8") as xf:
+        arrays = {c: np.asarray(vd[c], dtype=np.float64) for c in _TRAJECTORY_COLUMNS}
+        # Leave out the optional attributes that are zero along the whole trajectory
+        optional = {attr: c for attr, c in _OPTIONAL_ATTRIBUTES.items() if arrays[c].any()}
+        # Fragment of a single trajectory vertex, formatted with (time, x, y, *optional)
+        template = (f'<Vertex time="{_FLOAT_FORMAT}"><Position><WorldPosition x="{_FLOAT_FORMAT}" y="{_FLOAT_FORMAT}"'
+                    + ''.join(f' {attr}="{_FLOAT_FORMAT}"' for attr in optional)
+                    + '/></Position></Vertex>')
+        written = [arrays[c] for c in ['timestamp', 'x', 'y', *optional.values()]]
+        # Create the trajectory element for this vehicle
+        with xf.element("Trajectory", name=f"{vehicle_name}_Trajectory", closed="false"), \
+                xf.element("Shape"), \
+                xf.element("Polyline"):
+
+            # Add vertices to the polyline as pre-formatted fragments written straight to the stream
+            xf.flush()
+            for start in range(0, len(arrays['timestamp']), _CHUNK_SIZE):
+                # Convert one chunk of coordinates to Python floats per column, they are formatted by the template
+                columns = zip(*(a[start:start + _CHUNK_SIZE].tolist() for a in written))
+                file.writelines((template % vertex).encode() for vertex in columns)
+
+def _trajectory_bytes(vehicle_name: str, vd) -> bytes:
+    """
+    Serializes the Trajectory element of a single vehicle to UTF-8 encoded bytes, used by the worker processes.
+    """
+    buffer = BytesIO()
+    _serialize_trajectory(buffer, vehicle_name, vd)
+    return buffer.getvalue()
+
+def generate_osc(vehicle_data: dict, filename: str = "example_trajectory.xosc", pretty_print: bool = False,
+                 workers: int = None):
     """
     Generates an OpenSCENARIO file with trajectories for multiple vehicles, including entities and a storyboard.
 
@@ -16,105 +75,112 @@ def generate_osc(vehicle_data: dict, filename: str = "example_trajectory.xosc"):
         - 'timestamp': list of the timestamps corresponding to each position along the trajectory.
 
     - filename: str, the name of the output OpenSCENARIO file.
+    - pretty_print: bool, whether to indent the output file for human inspection (slower, larger file).
+    - workers: int, number of worker processes used to serialize the trajectories. By default (None) the trajectories
+      are written in-process straight into the output file. With workers > 1 a process pool is always used, each
+      trajectory is then held in memory until it is written. With the spawn/forkserver start methods the calling
+      script needs an `if __name__ == '__main__'` guard.
 
     Output:
     - An OpenSCENARIO file stored at the specified filename.
     """
-    # Create the root element for the OpenSCENARIO file
-    openscenario = etree.Element("OpenSCENARIO")
-
-    # Add the Entities section
-    entities = etree.SubElement(openscenario, "Entities")
-    for vehicle_name in vehicle_data.keys():
-        scenario_object = etree.SubElement(entities, "ScenarioObject", name=vehicle_name)
-        vehicle = etree.SubElement(scenario_object, "Vehicle", name=vehicle_name, vehicleCategory="car")
-        etree.SubElement(vehicle, "ParameterDeclarations")
-
-    # Add the Storyboard section
-    storyboard = etree.SubElement(openscenario, "Storyboard")
-
-    # Add the Init section (initialization of the scenario)
-    init = etree.SubElement(storyboard, "Init")
-    actions = etree.SubElement(init, "Actions")
-
-    for vehicle_name in vehicle_data.keys():
-        private_action = etree.SubElement(actions, "Private", entityRef=vehicle_name)
-        private_position_action = etree.SubElement(private_action, "PrivateAction")
-        teleport_action = etree.SubElement(private_position_action, "TeleportAction")
-        position = etree.SubElement(teleport_action, "Position")
-        etree.SubElement(position, "WorldPosition", 
-                         x=str(vehicle_data[vehicle_name]['x'][0]), 
-                         y=str(vehicle_data[vehicle_name]['y'][0]), 
-                         z=str(vehicle_data[vehicle_name]['z'][0]),
-                         h=str(vehicle_data[vehicle_name]['yaw'][0]),
-                         p=str(vehicle_data[vehicle_name]['pitch'][0]),
-                         r=str(vehicle_data[vehicle_name]['roll'][0]),
-                         )
-
-    # Add the Story section with a Maneuver for each vehicle
-    story = etree.SubElement(storyboard, "Story", name="MainStory")
-    act = etree.SubElement(story, "Act", name="MainAct")
-    maneuver_group = etree.SubElement(act, "ManeuverGroup", maximumExecutionCount="1", name="ManeuverGroup1")
-
-    for vehicle_name in vehicle_data.keys():
-        maneuver = etree.SubElement(maneuver_group, "Maneuver", name=f"{vehicle_name}_Maneuver")
-        event = etree.SubElement(maneuver, "Event", name="Event1", priority="overwrite")
-        action = etree.SubElement(event, "Action", name="Action1")
-        private_action = etree.SubElement(action, "PrivateAction")
-        routing_action = etree.SubElement(private_action, "RoutingAction")
-        assign_route_action = etree.SubElement(routing_action, "AssignRouteAction")
-        route = etree.SubElement(assign_route_action, "Route", closed="false")
-
-
-    # Add Trajectories
-    for vehicle_name in vehicle_data:
-        timestamps = vehicle_data[vehicle_name]['timestamp']
-        # Create the trajectory element for this vehicle
-        trajectory = etree.SubElement(openscenario, "Trajectory", name=f"{vehicle_name}_Trajectory", closed="false")
-        shape = etree.SubElement(trajectory, "Shape")
-        polyline = etree.SubElement(shape, "Polyline")
-
-        # Add vertices to the polyline
-        for i in range(len(timestamps)):
-            vertex = etree.SubElement(polyline, "Vertex", time=str(timestamps[i]))
-            position = etree.SubElement(vertex, "Position")
-            etree.SubElement(position, "WorldPosition", 
-                         x=str(vehicle_data[vehicle_name]['x'][i]), 
-                         y=str(vehicle_data[vehicle_name]['y'][i]), 
-                         z=str(vehicle_data[vehicle_name]['z'][i]),
-                         h=str(vehicle_data[vehicle_name]['yaw'][i]),
-                         p=str(vehicle_data[vehicle_name]['pitch'][i]),
-                         r=str(vehicle_data[vehicle_name]['roll'][i]),
-                         )
-
-    # Convert the XML tree to a string
-    xml_str = etree.tostring(openscenario, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-
-    # Write the XML string to a file
-    with open(filename, "wb") as file:
-        file.write(xml_str)
+    items = list(vehicle_data.items())
+
+    # Write next to the target and move it into place once complete, so a failure never leaves a partial file
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    try:
+        with open(fd, "wb", buffering=_WRITE_BUFFER_SIZE) as file, etree.xmlfile(file, encoding="UTF-8") as xf:
+            xf.write_declaration()
+            # Stream the OpenSCENARIO file element by element instead of building the whole tree in memory
+            with xf.element("OpenSCENARIO"):
+
+                # Add the Entities section
+                with xf.element("Entities"):
+                    for vehicle_name, _ in items:
+                        with xf.element("ScenarioObject", name=vehicle_name):
+                            with xf.element("Vehicle", name=vehicle_name, vehicleCategory="car"):
+                                xf.write(etree.Element("ParameterDeclarations"))
+
+                # Add the Storyboard section
+                with xf.element("Storyboard"):
+
+                    # Add the Init section (initialization of the scenario)
+                    with xf.element("Init"), xf.element("Actions"):
+                        for vehicle_name, vd in items:
+                            with xf.element("Private", entityRef=vehicle_name), \
+                                    xf.element("PrivateAction"), \
+                                    xf.element("TeleportAction"), \
+                                    xf.element("Position"):
+                                attrs = {'x': _FLOAT_FORMAT % float(vd['x'][0]), 'y': _FLOAT_FORMAT % float(vd['y'][0])}
+                                for attr, c in _OPTIONAL_ATTRIBUTES.items():
+                                    if vd[c][0] != 0:
+                                        attrs[attr] = _FLOAT_FORMAT % float(vd[c][0])
+                                xf.write(etree.Element("WorldPosition", attrib=attrs))
+
+                    # Add the Story section with a Maneuver for each vehicle
+                    with xf.element("Story", name="MainStory"), \
+                            xf.element("Act", name="MainAct"), \
+                            xf.element("ManeuverGroup", maximumExecutionCount="1", name="ManeuverGroup1"):
+                        for vehicle_name, _ in items:
+                            with xf.element("Maneuver", name=f"{vehicle_name}_Maneuver"), \
+                                    xf.element("Event", name="Event1", priority="overwrite"), \
+                                    xf.element("Action", name="Action1"), \
+                                    xf.element("PrivateAction"), \
+                                    xf.element("RoutingAction"), \
+                                    xf.element("AssignRouteAction"):
+                                xf.write(etree.Element("Route", closed="false"))
+
+                # Add Trajectories, each vehicle is serialized independently
+                xf.flush()
+                if workers is not None and workers > 1:
+                    # Only send the coordinate arrays to the workers instead of whole DataFrames
+                    names = [vehicle_name for vehicle_name, _ in items]
+                    columns = [{c: np.asarray(vd[c], dtype=np.float64) for c in _TRAJECTORY_COLUMNS}
+                               for _, vd in items]
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        file.writelines(executor.map(_trajectory_bytes, names, columns))
+                else:
+                    for vehicle_name, vd in items:
+                        _serialize_trajectory(file, vehicle_name, vd)
+
+        if pretty_print:
+            # Re-serialize the written file with indentation for debugging
+            etree.parse(tmp_filename).write(tmp_filename, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+        # mkstemp creates the file readable by the owner only, give it the permissions a plain open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filename, 0o666 & ~umask)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
 
 
 def compute_velocity(actor_log: pd.DataFrame):
     # Compute differences between successive positions and timestamps
-    positions = np.hstack([actor_log[c].to_numpy().reshape((-1,1)) for c in ['x','y','z']])
+    positions = actor_log[['x','y','z']].to_numpy()
     timestamps = actor_log['timestamp'].to_numpy()
     delta_positions = np.diff(positions, axis=0)
     delta_timestamps = np.diff(timestamps).reshape((-1, 1))
 
+    # Keep a zero for the initial velocity (since there's no motion before the first point)
+    # Column-major so that each velocity component v[:, i] is a contiguous float64 column
+    velocities = np.zeros((len(positions), 3), order='F')
     # Compute velocities (magnitude of the displacement vector divided by time)
-    velocities = delta_positions / delta_timestamps
-    # Prepend a zero for the initial velocity and heading (since there's no motion before the first point)
-    velocities = np.vstack([[0,0,0], velocities])
+    np.divide(delta_positions, delta_timestamps, out=velocities[1:])
 
     return velocities
 
 def compute_heading(actor_log: pd.DataFrame):
-    yaw = np.arctan2(actor_log['y'].to_numpy()[1:].reshape(-1,1), actor_log['x'].to_numpy()[1:].reshape(-1,1))
+    x = actor_log['x'].to_numpy()
+    y = actor_log['y'].to_numpy()
+    yaw = np.empty(len(x))
 
-    # Prepend a zero for the initial velocity and heading (since there's no motion before the first point)
-    yaw0 = actor_log['yaw'].to_numpy()[0].reshape(1,1)
-    return np.vstack([yaw0, yaw0 + yaw])
+    # Keep the initial heading (since there's no motion before the first point)
+    yaw[0] = actor_log['yaw'].to_numpy()[0]
+    # Compute headings from the direction of the displacement between successive positions
+    np.arctan2(np.diff(y), np.diff(x), out=yaw[1:])
+    return yaw
 
 def parse_osc(filename: str):
     """
@@ -128,48 +194,47 @@ def parse_osc(filename: str):
         - timestamps, x, y, z positions, velocities, and headings.
     """
     
-    # Parse the OpenSCENARIO file
-    tree = etree.parse(filename)
-    root = tree.getroot()
-
     # Initialize the dictionary to store vehicle dataframes
     vehicle_dataframes = []
 
-    # Find all Trajectory elements
-    for trajectory in root.findall(".//Trajectory"):
+    # Stream the OpenSCENARIO file, releasing every Trajectory once it has been read
+    for _, trajectory in etree.iterparse(filename, events=('end',), tag='Trajectory'):
         vehicle_name = trajectory.attrib['name'].replace("_Trajectory", "")
-        poses = []
-        timestamps = []
+        vertices = _FIND_VERTICES(trajectory)
+        # Store one contiguous row per pose component so each can become a DataFrame column without copying
+        poses = np.empty((6, len(vertices)))
+        timestamps = np.empty(len(vertices))
         # Extract positions and timestamps
-        for vertex in trajectory.findall(".//Vertex"):
-            time = float(vertex.attrib['time'])
-            position = vertex.find(".//WorldPosition")
-            x = float(position.attrib['x'])
-            y = float(position.attrib['y'])
-            z = float(position.attrib['z'])
-            yaw = float(position.attrib.get('h',0.))
-            pitch = float(position.attrib.get('p',0.))
-            roll = float(position.attrib.get('r',0.))
-
-            timestamps.append(time)
-            poses.append([x, y, z, yaw, pitch, roll])
-        poses = np.array(poses)
+        for i, vertex in enumerate(vertices):
+            timestamps[i] = float(vertex.attrib['time'])
+            position = _FIND_WORLD_POSITION(vertex)[0].attrib
+            poses[0, i] = float(position['x'])
+            poses[1, i] = float(position['y'])
+            poses[2, i] = float(position.get('z',0.))
+            poses[3, i] = float(position.get('h',0.))
+            poses[4, i] = float(position.get('p',0.))
+            poses[5, i] = float(position.get('r',0.))
+
         # Create a DataFrame for the vehicle
-        df = {
+        df = pd.DataFrame({
             'timestamp': timestamps,
-            'x': poses[:, 0].tolist(),
-            'y': poses[:, 1].tolist(),
-            'z': poses[:, 2].tolist(),
-            'yaw': poses[:, 3].tolist(),
-            'pitch': poses[:, 4].tolist(),
-            'roll': poses[:, 5].tolist(),
-        }
-        df = pd.DataFrame(df)
-        df['name'] = [vehicle_name] * len(df['timestamp'])
+            'x': poses[0],
+            'y': poses[1],
+            'z': poses[2],
+            'yaw': poses[3],
+            'pitch': poses[4],
+            'roll': poses[5],
+            'name': vehicle_name,
+        }, copy=False)
 
         # Store the DataFrame in the dictionary
         vehicle_dataframes += [df]
 
+        # Free the processed trajectory and the elements already read before it
+        trajectory.clear()
+        while trajectory.getprevious() is not None:
+            del trajectory.getparent()[0]
+
     return vehicle_dataframes
 
 if __name__ == '__main__':
@@ -198,25 +263,27 @@ if __name__ == '__main__':
     }
     df2 = pd.DataFrame(vehicle2)
     df2['name'] = ['vehicle2'] * len(df2['timestamp'])
-    df2['yaw'] = compute_heading(df2)
+    df2 = df2.assign(yaw=compute_heading(df2))
     dfs = [df1, df2]
-    for df in dfs:
+    for i, df in enumerate(dfs):
         v = compute_velocity(df)
-        df['vx'] = v[:, 0]
-        df['vy'] = v[:, 1]
-        df['yaw'] = compute_heading(df)
+        dfs[i] = df.assign(vx=v[:, 0], vy=v[:, 1], yaw=compute_heading(df))
 
     print( pd.concat(dfs).to_string())
     
-    generate_osc({'vehicle1':df1, 'vehicle2':df2}, "multiple_vehicles_trajectory.xosc")
+    generate_osc({'vehicle1':dfs[0], 'vehicle2':dfs[1]}, "multiple_vehicles_trajectory.xosc")
     dfs_parsed = parse_osc("multiple_vehicles_trajectory.xosc")
-    for df in dfs_parsed:
+    for i, df in enumerate(dfs_parsed):
         v = compute_velocity(df)
-        df['vx'] = v[:, 0]
-        df['vy'] = v[:, 1]
+        dfs_parsed[i] = df.assign(vx=v[:, 0], vy=v[:, 1])
     print(pd.concat(dfs_parsed).to_string())
-    diff = pd.concat(dfs).compare(pd.concat(dfs_parsed))
+    expected = pd.concat(dfs)
+    parsed = pd.concat(dfs_parsed)
+    assert list(expected.columns) == list(parsed.columns)
+    values = expected.drop(columns='name').to_numpy()
+    values_parsed = parsed.drop(columns='name').to_numpy()
 
     print('Difference: ')
-    print(diff)
-    assert pd.concat(dfs).equals(pd.concat(dfs_parsed))
\ No newline at end of file
+    print(np.abs(values - values_parsed).max(axis=0))
+    assert np.array_equal(values, values_parsed)
+    assert np.array_equal(expected['name'].to_numpy(), parsed['name'].to_numpy())